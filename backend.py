@@ -2,6 +2,7 @@ import aiohttp
 import argparse
 import asyncio
 import daemon
+import heapq
 import json
 import os
 import re
@@ -18,6 +19,13 @@ from db import connect
 # This is a public value from the Twitter source code.
 TWITTER_AUTH_KEY = 'AAAAAAAAAAAAAAAAAAAAANRILgAAAAAAnNwIzUejRCOuH5E6I8xnZz4puTs%3D1Zv7ttfk8LF81IUq16cHjhLTvJu4FA33AGWWjCpTnA'
 
+# guest sessions renew their token once the rate limit budget drops below this
+GUEST_RENEW_REMAINING = 10
+
+# rough upper estimate of requests one TwitterSession.test makes;
+# test_ghost_ban and test_barrier fetch one conversation per reply
+PREWARM_TEST_COST = 40
+
 
 routes = web.RouteTableDef()
 
@@ -44,6 +52,7 @@ debug_file = None
 guest_session_pool_size = 10
 guest_sessions = []
 test_index = 0
+prewarm_tracker = None
 
 def next_session():
     def key(s):
@@ -55,6 +64,175 @@ def next_session():
     if len(sessions) > 0:
         return sessions[0]
 
+class HandleTracker:
+    # Keeps an exponentially decaying request count per handle, so that
+    # frequently tested handles can be re-tested in the background and
+    # served from `results` while they are fresh.
+    def __init__(self, half_life=3600, max_tracked=1000):
+        self.half_life = half_life
+        self.max_tracked = max_tracked
+        # handle (lowercase) -> [score, last update timestamp]
+        self.scores = {}
+        # handle (lowercase) -> last test result
+        self.results = {}
+        # handle (lowercase) -> [last background attempt timestamp, consecutive failures]
+        self.attempts = {}
+        # handles picked by the last refresh_hot, checked on every request
+        self.hot = set()
+
+    def decayed(self, handle, now=None):
+        if handle not in self.scores:
+            return 0
+        if now is None:
+            now = time.time()
+        score, updated = self.scores[handle]
+        return score * 0.5 ** ((now - updated) / self.half_life)
+
+    def hit(self, handle):
+        handle = handle.lower()
+        now = time.time()
+        self.scores[handle] = [self.decayed(handle, now) + 1, now]
+        if len(self.scores) > self.max_tracked:
+            self.prune(now)
+
+    def prune(self, now):
+        # drop the coldest quarter, keeping room for new handles
+        keep = heapq.nlargest(self.max_tracked * 3 // 4, self.scores, key=lambda h: self.decayed(h, now))
+        self.scores = {h: self.scores[h] for h in keep}
+        self.results = {h: r for h, r in self.results.items() if h in self.scores}
+        self.attempts = {h: a for h, a in self.attempts.items() if h in self.scores}
+
+    def top(self, count):
+        now = time.time()
+        return heapq.nlargest(count, self.scores, key=lambda h: self.decayed(h, now))
+
+    def refresh_hot(self, count):
+        top = self.top(count)
+        self.hot = set(top)
+        return top
+
+    def is_hot(self, handle):
+        return handle.lower() in self.hot
+
+    def due(self, handle, interval):
+        # background attempts are spaced by `interval`, doubling per consecutive failure
+        attempt = self.attempts.get(handle, None)
+        if attempt is None:
+            return True
+        last, failures = attempt
+        return time.time() - last >= interval * 2 ** min(failures, 3)
+
+    def attempted(self, handle, stored):
+        failures = 0
+        if not stored:
+            failures = self.attempts.get(handle, [0, 0])[1] + 1
+        self.attempts[handle] = [time.time(), failures]
+
+    def store(self, handle, result, complete=True):
+        # keep final outcomes, including ENOREPLIES/EISGHOSTED and "nothing found" (None),
+        # but never serve failed or rate limited tests to other callers
+        if not complete:
+            return False
+        for test in result.get("tests", {}).values():
+            if isinstance(test, dict) and test.get("error", None) == "EUNKNOWN":
+                return False
+        handle = handle.lower()
+        if handle not in self.scores:
+            return False
+        self.results[handle] = result
+        return True
+
+    def age(self, handle):
+        result = self.results.get(handle.lower(), None)
+        if result is None:
+            return None
+        return time.time() - result["timestamp"]
+
+    def fresh(self, handle, max_age):
+        age = self.age(handle)
+        if age is None or age > max_age:
+            return None
+        return self.results[handle.lower()]
+
+def hour_range(value):
+    # parses a UTC hour range like "1-6" into (1, 6)
+    try:
+        start, end = [int(x) for x in value.split('-')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected an hour range like 1-6, got %s' % value)
+    if not 0 <= start <= 23 or not 0 <= end <= 24:
+        raise argparse.ArgumentTypeError('hours must be within 0-24, got %s' % value)
+    return (start, end)
+
+def is_offpeak(hours, now=None):
+    # `hours` is a (start, end) tuple; wraps around midnight for e.g. (22, 4)
+    if hours is None:
+        return False
+    start, end = hours
+    hour = time.gmtime(now).tm_hour
+    if start <= end:
+        return start <= hour < end
+    return hour >= start or hour < end
+
+def spare_session(min_remaining):
+    # guest session with the most rate limit budget left, if it has enough to spare
+    sessions = [s for s in guest_sessions if not s.locked]
+    if len(sessions) == 0:
+        return None
+    session = max(sessions, key=lambda s: s.remaining)
+    if session.remaining < min_remaining:
+        return None
+    return session
+
+async def prewarm_loop():
+    while True:
+        await asyncio.sleep(args.prewarm_interval)
+        # always keep enough budget for one full test above the guest token renewal threshold;
+        # off-peak, spend down to exactly that
+        floor = GUEST_RENEW_REMAINING + PREWARM_TEST_COST
+        min_remaining = max(args.prewarm_min_remaining, floor)
+        if is_offpeak(args.prewarm_offpeak_hours):
+            min_remaining = floor
+        for handle in prewarm_tracker.refresh_hot(args.prewarm_top):
+            age = prewarm_tracker.age(handle)
+            if age is not None and age < args.prewarm_max_age / 2:
+                continue
+            if not prewarm_tracker.due(handle, args.prewarm_max_age / 2):
+                continue
+            session = spare_session(min_remaining)
+            if session is None:
+                debug('[prewarm] No spare session budget, pausing')
+                break
+            try:
+                result, complete = await session.test_with_status(handle, record=False)
+            except asyncio.CancelledError:
+                raise
+            except UnexpectedApiError:
+                debug('[prewarm] Unexpected API error for ' + handle)
+                prewarm_tracker.attempted(handle, False)
+                continue
+            except:
+                debug('[prewarm] Unexpected Exception:')
+                debug(traceback.format_exc())
+                prewarm_tracker.attempted(handle, False)
+                continue
+            stored = prewarm_tracker.store(handle, result, complete)
+            prewarm_tracker.attempted(handle, stored)
+            if stored:
+                debug('[prewarm] Refreshed ' + handle)
+            else:
+                debug('[prewarm] Discarded incomplete result for ' + handle)
+
+async def start_prewarm(app):
+    app['prewarm'] = asyncio.ensure_future(prewarm_loop())
+
+async def stop_prewarm(app):
+    app['prewarm'].cancel()
+    try:
+        await app['prewarm']
+    except asyncio.CancelledError:
+        pass
+
 class TwitterSession:
     twitter_auth_key = None
 
@@ -193,7 +371,7 @@ class TwitterSession:
                 await self.login_guest()
             raise e
         self.monitor_rate_limit(r.headers)
-        if self.username is None and self.remaining < 10 or is_error(result, 88) or is_error(result, 239):
+        if self.username is None and self.remaining < GUEST_RENEW_REMAINING or is_error(result, 88) or is_error(result, 239):
             await self.login_guest()
         if retries > 0 and is_error(result, 353):
             return await self.get(url, retries - 1)
@@ -386,7 +564,14 @@ class TwitterSession:
             debug(traceback.format_exc())
             return { "error": "EUNKNOWN" }
 
-    async def test(self, username):
+    async def test(self, username, record=True):
+        result, complete = await self.test_with_status(username, record)
+        return result
+
+    async def test_with_status(self, username, record=True):
+        # returns the result and whether all API calls succeeded;
+        # `record` is False for background re-tests, which are not written to the DB
+        complete = True
         result = {"timestamp": time.time()}
         profile = {}
         profile_raw = await self.profile_raw(username)
@@ -426,11 +611,13 @@ class TwitterSession:
         result["profile"] = profile
 
         if not profile["exists"] or profile.get("suspended", False) or profile.get("protected", False) or not profile.get('has_tweets'):
-            return result
+            return result, complete
 
         result["tests"] = {}
 
         search_raw = await self.search_raw("from:@" + username)
+        if isinstance(search_raw.get("errors", None), list):
+            complete = False
 
         result["tests"]["search"] = False
         try:
@@ -443,6 +630,8 @@ class TwitterSession:
             pass
 
         typeahead_raw = await self.typeahead_raw("@" + username)
+        if isinstance(typeahead_raw.get("errors", None), list):
+            complete = False
         result["tests"]["typeahead"] = False
         try:
             result["tests"]["typeahead"] = len([1 for user in typeahead_raw["users"] if user["screen_name"].lower() == username.lower()]) > 0
@@ -459,10 +648,10 @@ class TwitterSession:
         else:
             result["tests"]["more_replies"] = { "error": "EISGHOSTED"}
 
-        debug('[' + profile['screen_name'] + '] Writing result to DB')
-        if db is not None:
+        if db is not None and record:
+            debug('[' + profile['screen_name'] + '] Writing result to DB')
             db.write_result(result)
-        return result
+        return result, complete
 
 
     async def close(self):
@@ -519,10 +708,23 @@ async def unlocked(request):
 async def api(request):
     global test_index
     screen_name = request.match_info['screen_name']
-    session = guest_sessions[test_index % len(guest_sessions)]
-    test_index += 1
-    result = await session.test(screen_name)
-    log(json.dumps(result) + '\n')
+    result = None
+    hot = False
+    if prewarm_tracker is not None:
+        prewarm_tracker.hit(screen_name)
+        hot = prewarm_tracker.is_hot(screen_name)
+    if hot:
+        result = prewarm_tracker.fresh(screen_name, args.prewarm_max_age)
+    if result is None:
+        session = guest_sessions[test_index % len(guest_sessions)]
+        test_index += 1
+        result, complete = await session.test_with_status(screen_name)
+        if hot:
+            prewarm_tracker.store(screen_name, result, complete)
+        log(json.dumps(result) + '\n')
+    else:
+        # mark results served from the prewarm cache, their timestamp is that of the original test
+        log(json.dumps(dict(result, cached=True)) + '\n')
     if (args.cors_allow is not None):
         return web.json_response(result, headers={"Access-Control-Allow-Origin": args.cors_allow})
     else:
@@ -565,6 +767,12 @@ parser.add_argument('--mongo-port', type=int, default=27017, help='port of mongo
 parser.add_argument('--mongo-db', type=str, default='tester', help='name of mongo database to use')
 parser.add_argument('--twitter-auth-key', type=str, default=TWITTER_AUTH_KEY, help='auth key for twitter guest session')
 parser.add_argument('--cors-allow', type=str, default=None, help='value for Access-Control-Allow-Origin header')
+parser.add_argument('--prewarm-top', type=int, default=0, help='number of most requested handles to re-test in the background (0 disables)')
+parser.add_argument('--prewarm-interval', type=int, default=60, help='seconds between background re-test rounds')
+parser.add_argument('--prewarm-max-age', type=int, default=900, help='seconds a stored result is served without re-testing; served results are logged with "cached": true')
+parser.add_argument('--prewarm-half-life', type=int, default=3600, help='half-life in seconds of the per-handle request count')
+parser.add_argument('--prewarm-min-remaining', type=int, default=90, help='rate limit budget a guest session needs left to be used for re-tests')
+parser.add_argument('--prewarm-offpeak-hours', type=hour_range, default=None, help='UTC hour range, e.g. 1-6, in which re-tests only keep budget for one more test')
 args = parser.parse_args()
 
 TwitterSession.twitter_auth_key = args.twitter_auth_key
@@ -598,7 +806,7 @@ if args.debug is not None:
     debug_file = open(args.debug, "a")
 
 def run():
-    global db
+    global db, prewarm_tracker
     db = None
     if args.mongo_host is not None:
         db = connect(host=args.mongo_host, port=args.mongo_port)
@@ -607,6 +815,11 @@ def run():
     loop.run_until_complete(login_guests())
     app = web.Application()
     app.add_routes(routes)
+    if args.prewarm_top > 0:
+        prewarm_tracker = HandleTracker(half_life=args.prewarm_half_life, max_tracked=max(1000, args.prewarm_top * 10))
+        app.on_startup.append(start_prewarm)
+        app.on_cleanup.append(stop_prewarm)
+        debug('[prewarm] Re-testing top ' + str(args.prewarm_top) + ' handles every ' + str(args.prewarm_interval) + 's')
     web.run_app(app, host=args.host, port=args.port)
 
 if args.daemon: